@@ -44,9 +44,9 @@ class Trainer(Wrapper):
         train_pred = []
 
         for batch, (x, y) in progress_bar:
-            train_true.extend(y.tolist())
-            x = x.to(self.device)
-            y = y.to(self.device)
+            train_true.append(y)
+            x = x.to(self.device, non_blocking=True)
+            y = y.to(self.device, non_blocking=True)
 
             self.optimizer.zero_grad()
 
@@ -63,7 +63,7 @@ class Trainer(Wrapper):
                 loss = self.loss_function(out, y)
                 out = out.argmax(dim=-1)
 
-            train_pred.extend(out.tolist())
+            train_pred.append(out.detach())
 
             losses.append(loss.item())
             loss.backward()
@@ -71,7 +71,7 @@ class Trainer(Wrapper):
 
             progress_bar.set_postfix(ce_loss=loss.item())
 
-        return losses, (train_true, train_pred)
+        return losses, (torch.cat(train_true).tolist(), torch.cat(train_pred).tolist())
 
     def test_evaluation(self, **kwargs):
 
@@ -81,25 +81,34 @@ class Trainer(Wrapper):
         noises = []
 
         self.model.eval()
-        with torch.no_grad():
+        with torch.inference_mode():
             for i, (x, y) in enumerate(self.test_data):
-                y_all.extend(y.tolist())
-                x_all.extend(x.tolist())
+                y_all.append(y)
+                x_all.append(x)
 
-                out = self.model(x.to(self.device))
+                x = x.to(self.device, non_blocking=True)
+
+                out = self.model(x)
 
                 if not self.regression:
                     out = out.argmax(dim=-1)
-                    pred.extend(out.tolist())
+                    pred.append(out)
                 else:
-                    pred.extend(out[:, 0].tolist())
+                    pred.append(out[:, 0])
                     if self.model.classes == 2:
-                        noises.extend(out[:, 1].exp().tolist())
+                        noises.append(out[:, 1].exp())
+
+        y_all = torch.cat(y_all).tolist()
+        pred = torch.cat(pred).tolist()
 
         if not self.regression:
             return y_all, pred
 
+        x_all = torch.cat(x_all).tolist()
+
         if len(noises) == 0:
             noises = self.model.noise.exp().item()
+        else:
+            noises = torch.cat(noises).tolist()
 
         return x_all, y_all, pred, noises
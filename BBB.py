@@ -29,40 +29,32 @@ class BBB(Network):
 
     def _forward(self, x):
 
-        tot_prior = 0
-        tot_post = 0
+        tot_kl = 0
 
         for j, i in enumerate(self.features):
             if not isinstance(i, (BayesianLinearLayer, BayesianCNNLayer)):
                 x = i(x)
             else:
-                x, prior, post = i(x,  self.calculate_kl)
-                tot_post += post
-                tot_prior += prior
+                x, kl = i(x,  self.calculate_kl)
+                tot_kl += kl
 
-        return x, tot_prior, tot_post
+        return x, tot_kl
 
     def forward(self, x, samples=1):
         o = []
-        log_priors = []
-        log_posts = []
+        kls = []
 
         for i in range(samples):
-            op, prior, post = self._forward(x)
+            op, kl = self._forward(x)
             o.append(op)
-            log_priors.append(prior)
-            log_posts.append(post)
+            kls.append(kl)
 
         o = torch.stack(o)
-        log_priors = torch.stack(log_priors)
-        log_posts = torch.stack(log_posts)
-
-        log_prior = log_priors.mean()
-        log_post = log_posts.mean()
-        return o, log_prior, log_post
+        kl = torch.stack(kls).mean()
+        return o, kl
 
     def eval_forward(self, x, samples=1):
-        o, _, _ = self(x, samples=samples)
+        o, _ = self(x, samples=samples)
         return o
 
 
@@ -94,15 +86,15 @@ class Trainer(Wrapper):
         self.model.calculate_kl = True
 
         for batch, (x, y) in progress_bar:
-            train_true.extend(y.tolist())
-            y = y.to(self.device)
-            x = x.to(self.device)
+            train_true.append(y)
+            y = y.to(self.device, non_blocking=True)
+            x = x.to(self.device, non_blocking=True)
 
             self.optimizer.zero_grad()
 
-            out, prior, post = self.model(x, samples=samples)
+            out, kl = self.model(x, samples=samples)
 
-            logloss = (post - prior) * pi[batch] #/ x.shape[0]
+            logloss = kl * pi[batch] #/ x.shape[0]
 
             if pi[batch] == 0:
                 self.model.calculate_kl = False
@@ -131,9 +123,9 @@ class Trainer(Wrapper):
 
             self.optimizer.step()
 
-            train_pred.extend(out.tolist())
+            train_pred.append(out.detach())
 
-        return losses, (train_true, train_pred)
+        return losses, (torch.cat(train_true).tolist(), torch.cat(train_pred).tolist())
 
     def train_step(self, train_samples=1, test_samples=1, **kwargs):
         losses, train_res = self.train_epoch(samples=train_samples)
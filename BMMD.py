@@ -7,7 +7,7 @@ from tqdm import tqdm
 
 from base import Wrapper, get_bayesian_network, Network
 from priors import Gaussian
-from bayesian_layers import BayesianCNNLayer, BayesianLinearLayer
+from bayesian_layers import BayesianCNNLayer, BayesianLinearLayer, sample_all_priors
 
 
 class BMMD(Network):
@@ -30,6 +30,9 @@ class BMMD(Network):
 
     def _forward(self, x):
 
+        if self.training and self.calculate_mmd:
+            sample_all_priors(self.features)
+
         mmd = 0
         for j, i in enumerate(self.features):
             if not isinstance(i, (BayesianLinearLayer, BayesianCNNLayer)):
@@ -95,10 +98,10 @@ class Trainer(Wrapper):
 
         for batch, (x, y) in progress_bar:
 
-            train_true.extend(y.tolist())
+            train_true.append(y)
 
-            y = y.to(self.device)
-            x = x.to(self.device)
+            y = y.to(self.device, non_blocking=True)
+            x = x.to(self.device, non_blocking=True)
             self.optimizer.zero_grad()
 
             out, mmd = self.model(x, samples=samples)
@@ -123,7 +126,7 @@ class Trainer(Wrapper):
                 out = torch.softmax(out, -1).mean(0)
                 out = out.argmax(dim=-1)
 
-            train_pred.extend(out.tolist())
+            train_pred.append(out.detach())
 
             tot_loss = mmd + loss
 
@@ -138,7 +141,7 @@ class Trainer(Wrapper):
 
             progress_bar.set_postfix(ce_loss=loss.item(), mmd_loss=mmd.item())
 
-        return losses, (train_true, train_pred)
+        return losses, (torch.cat(train_true).tolist(), torch.cat(train_pred).tolist())
 
     def train_step(self, train_samples=1, test_samples=1, **kwargs):
         losses, train_res = self.train_epoch(samples=train_samples, **kwargs)
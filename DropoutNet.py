@@ -59,9 +59,9 @@ class Trainer(Wrapper):
         train_pred = []
 
         for batch, (x, y) in progress_bar:
-            x = x.to(self.device)
-            y = y.to(self.device)
-            train_true.extend(y.tolist())
+            train_true.append(y)
+            x = x.to(self.device, non_blocking=True)
+            y = y.to(self.device, non_blocking=True)
 
             self.optimizer.zero_grad()
 
@@ -82,7 +82,7 @@ class Trainer(Wrapper):
                 out = torch.softmax(out, -1).mean(0)
                 out = out.argmax(dim=-1)
 
-            train_pred.extend(out.tolist())
+            train_pred.append(out.detach())
 
             if self.wd != 0:
                 l2_reg = torch.tensor(0.).to(self.device)
@@ -97,7 +97,7 @@ class Trainer(Wrapper):
 
             progress_bar.set_postfix(ce_loss=loss.item())
 
-        return losses, (train_true, train_pred)
+        return losses, (torch.cat(train_true).tolist(), torch.cat(train_pred).tolist())
 
     def train_step(self, train_samples=1, test_samples=1, **kwargs):
         losses, train_res = self.train_epoch(samples=train_samples)
@@ -1,10 +1,11 @@
+import math
 from abc import ABC, abstractmethod
-from copy import deepcopy
 
 import numpy as np
 import torch
 import torch.nn.functional as F
 import torchvision.transforms as T
+from PIL import Image
 from sklearn import metrics
 from torch import nn, optim
 from tqdm import tqdm
@@ -21,55 +22,49 @@ class percentageRotation:
 
 class PixelShuffle:
     def __init__(self, percentage):
+        self.percentage = percentage
+
+    @property
+    def percentage(self):
+        return self._percentage
+
+    @percentage.setter
+    def percentage(self, percentage):
         if percentage < 0 or percentage > 1:
             raise ValueError('percentage should be between 0 and 1, {} wasa given'.format(percentage))
 
-        self.percentage = percentage
-        self.pixels_map = None
+        self._percentage = percentage
+        # (destination, source) flat pixel indexes, one pair for each image size
+        self.pixels_map = {}
 
     def shuffle_pixels(self, x):
-        x1 = x.copy()
-        if self.pixels_map is None:
-            w, h = x.size
-            pxs = []
-            for x in range(w):
-                for y in range(h):
-                    pxs.append((x, y))
+        x1 = np.array(x)
 
-            ln = len(pxs)
-            idx = np.arange(ln)
+        w, h = x.size
+        ln = w * h
 
-            pixels_map = \
-                zip(np.random.choice(idx, int(ln * self.percentage)), np.random.choice(idx, int(ln * self.percentage)))
+        if x.size not in self.pixels_map:
+            k = int(ln * self.percentage)
+            self.pixels_map[x.size] = (np.random.randint(0, ln, k), np.random.randint(0, ln, k))
 
-            self.pixels_map = [(pxs[i], x1.getpixel(pxs[j])) for i, j in pixels_map]
+        dst, src = self.pixels_map[x.size]
 
-        for a, b in self.pixels_map:
-            x1.putpixel(a, b)
+        pixels = x1.reshape(ln, -1)
+        pixels[dst] = pixels[src]
 
-        return x1
+        return Image.fromarray(x1)
 
     def __call__(self, x):
         x1 = self.shuffle_pixels(x)
         return x1
 
 
-class AddNoise:
-    def __init__(self, noise):
-        self.noise = noise
-
-    def __call__(self, x):
-        return x + torch.randn(x.size()) * self.noise
-
-
 # FGSM attack code
-def fgsm_attack(image, epsilon):
+def fgsm_attack(image, sign_data_grad, epsilon):
     if epsilon == 0:
         return image
-    # Collect the element-wise sign of the data gradient
-    sign_data_grad = image.grad.data.sign()
     # Create the perturbed image by adjusting each pixel of the input image
-    perturbed_image = image + epsilon * sign_data_grad
+    perturbed_image = image + epsilon * sign_data_grad.to(image.dtype)
     # Adding clipping to maintain [0,1] range
     perturbed_image = torch.clamp(perturbed_image, 0, 1)
     # Return the perturbed image
@@ -87,76 +82,90 @@ def log_gaussian_loss(out_dim):
 
 def cross_entropy_loss(reduction):
     def loss_function(x, y):
-        _x = F.log_softmax(x, -1)
-        if _x.dim() == 3:
-            _x = _x.mean(0)
+        if x.dim() == 2:
+            return F.cross_entropy(x, y, reduction=reduction)
+        # the log probabilities are averaged over the samples before the nll
+        _x = F.log_softmax(x, -1).mean(0)
         return F.nll_loss(_x, y, reduction=reduction)
 
     return loss_function
 
+def _normalize_logdet(logdet, classes):
+    # (det - mn) / (mx - mn), with mn = 1 / C^C and mx = mn * 2^(C-1), evaluated from the log-determinant since
+    # mn underflows for a large number of classes
+    norm = 2 ** (classes - 1) - 1
+    return torch.exp(logdet + classes * math.log(classes) - math.log(norm)) - 1 / norm
+
+
 def det(x):
     t = x.shape[1]
     classes = x.shape[-1]
 
-    mn = 1 / classes ** classes
-    mx = mn * (2 ** (classes - 1))
-
-    det = np.linalg.det(x + (np.eye(classes) / classes))
-    det = (det - mn) / (mx - mn)
+    sign, logdet = np.linalg.slogdet(x + (np.eye(classes) / classes))
+    det = _normalize_logdet(torch.from_numpy(np.where(sign > 0, logdet, -np.inf)), classes).numpy()
 
     return det
 
 
-def epistemic_aleatoric_uncertainty(x):
-    if x.dim() == 2:
-        x = x.unsqueeze(0)
-
-    p = torch.softmax(x, 2)
+def _covariance(p):
     p_hat = torch.mean(p, 0)
+    p = p.transpose(0, 1)
 
-    p = p.detach().cpu().numpy()
-    p = np.transpose(p, (1, 0, 2))
+    classes = p.shape[-1]
 
-    p_hat = p_hat.detach().cpu().numpy()
+    if p.shape[1] == 1:
+        # with a single sample the epistemic term is zero and, by the matrix determinant lemma,
+        # det(diag(p + 1/C) - p p^T) = prod(p + 1/C) * (1 - sum(p^2 / (p + 1/C)))
+        p = p[:, 0]
+        d = p + 1 / classes
 
-    t = p.shape[1]
-    classes = p.shape[-1]
+        var = torch.diag_embed(p) - p.unsqueeze(-1) * p.unsqueeze(-2)
 
-    determinants = []
-    variances = []
+        det = _normalize_logdet(torch.log(d).sum(-1) + torch.log1p(-torch.sum(p ** 2 / d, -1)), classes)
 
-    mn = 1 / classes ** classes
-    mx = mn * (2 ** (classes - 1))
+        return det, var
 
-    for _bi in range(p.shape[0]):
-        _bp = p[_bi]
-        _bp_hat = p_hat[_bi]
+    # the sample means of diag(p) - p p^T and (p - p_hat)(p - p_hat)^T, as batched products over the samples
+    samples = p.shape[1]
+    aleatoric = torch.diag_embed(p_hat) - p.transpose(1, 2) @ p / samples
+    d = p - p_hat.unsqueeze(1)
+    epistemic = d.transpose(1, 2) @ d / samples
 
-        al = np.zeros((classes, classes))
-        ep = np.zeros((classes, classes))
+    var = aleatoric + epistemic
 
-        for i in range(t):
-            _p = _bp[i]
-            aleatoric = np.diag(_p) - np.outer(_p, _p)
-            al += aleatoric
-            d = _p - _bp_hat
-            epistemic = np.outer(d, d)
-            ep += epistemic
+    # the matrix is positive definite, a non positive sign can only come from round-off
+    sign, logdet = torch.linalg.slogdet(var + torch.eye(classes, device=p.device) / classes)
+    det = _normalize_logdet(torch.where(sign > 0, logdet, torch.full_like(logdet, -math.inf)), classes)
 
-        al /= t
-        ep /= t
+    return det, var
 
-        var = al + ep
 
-        variances.append(var)
+def _entropy(p):
+    classes = p.shape[-1]
 
-        det = np.linalg.det(var + (np.eye(classes) / classes))
-        det = (det - mn) / (mx - mn)
+    log_p = torch.special.entr(p).sum(-1)/np.log(classes)
+    return torch.mean(log_p, 0)
 
-        determinants.append(det)
 
-    determinants = np.asarray(determinants)
-    variances = np.asarray(variances)
+def uncertainties(x):
+    if x.dim() == 2:
+        x = x.unsqueeze(0)
+
+    p = torch.softmax(x, 2)
+
+    det, var = _covariance(p)
+    return det, var, _entropy(p)
+
+
+def epistemic_aleatoric_uncertainty(x):
+    if x.dim() == 2:
+        x = x.unsqueeze(0)
+
+    p = torch.softmax(x, 2)
+    determinants, variances = _covariance(p)
+
+    determinants = determinants.detach().cpu().numpy()
+    variances = variances.detach().cpu().numpy()
 
     return determinants, variances
 
@@ -166,35 +175,38 @@ def entropy(x):
         x = x.unsqueeze(0)
 
     p = torch.softmax(x, 2)
-    classes = p.shape[-1]
-
-    log_p = -torch.sum(p * torch.log(p + 1e-12), -1)/np.log(classes)
-    _entropy = torch.mean(log_p, 0)
 
-    return _entropy.tolist(), None
+    return _entropy(p).tolist(), None
 
 
 def compute_entropy(preds, sum=True):
-    l = torch.log10(preds + 1e-12) * preds
+    l = torch.special.entr(preds) / np.log(10)
     if sum:
-        return -torch.sum(l, 1)
+        return torch.sum(l, 1)
     else:
-        return -l
+        return l
+
+
+def _conv_output_shape(shape, channels, kernel_size, stride, padding=0):
+    _, h, w = shape
+    h = (h + 2 * padding - kernel_size) // stride + 1
+    w = (w + 2 * padding - kernel_size) // stride + 1
+    return channels, h, w
 
 
 def get_bayesian_network(topology, input_image, classes, mu_init, rho_init, prior, divergence, local_trick,
                          posterior_type, bias=True, **kwargs):
     features = torch.nn.ModuleList()
-    prev = input_image.shape[0]
-    input_image = input_image.unsqueeze(0)
+    # shape of a single activation, computed from the layers' hyperparameters without running them
+    shape = tuple(input_image.shape)
+    prev = shape[0]
     ll_conv = False
 
     for j, i in enumerate(topology):
 
         if isinstance(i, (tuple, list)) and i[0] == 'MP':
             l = torch.nn.MaxPool2d(kernel_size=i[1], stride=i[2])
-            input_image = l(input_image)
-            prev = input_image.shape[1]
+            shape = _conv_output_shape(shape, prev, i[1], i[2])
             ll_conv = True
 
         elif isinstance(i, str) and i.lower() == 'relu':
@@ -208,8 +220,7 @@ def get_bayesian_network(topology, input_image, classes, mu_init, rho_init, prio
 
         elif isinstance(i, (tuple, list)) and i[0] == 'AP':
             l = torch.nn.AvgPool2d(kernel_size=i[1], stride=i[2])
-            input_image = l(input_image)
-            prev = input_image.shape[1]
+            shape = _conv_output_shape(shape, prev, i[1], i[2])
             ll_conv = True
 
         elif isinstance(i, (tuple, list)):
@@ -219,13 +230,13 @@ def get_bayesian_network(topology, input_image, classes, mu_init, rho_init, prio
                                  mu_init=mu_init, divergence=divergence, local_rep_trick=local_trick, stride=stride,
                                  rho_init=rho_init, prior=prior, padding=padding, **kwargs)
 
-            input_image = l(input_image)[0]
-            prev = input_image.shape[1]
+            shape = _conv_output_shape(shape, size, kernel_size, stride, padding)
+            prev = size
+            ll_conv = True
 
         elif isinstance(i, int):
             if ll_conv:
-                input_image = torch.flatten(input_image, 1)
-                prev = input_image.shape[-1]
+                prev = int(np.prod(shape))
                 features.append(Flatten())
             ll_conv = False
 
@@ -234,6 +245,7 @@ def get_bayesian_network(topology, input_image, classes, mu_init, rho_init, prio
                                     rho_init=rho_init, prior=prior, local_rep_trick=local_trick, use_bias=bias,
                                     posterior_type=posterior_type, **kwargs)
             prev = size
+            shape = (size,)
 
         else:
             raise ValueError('Topology should be tuple for cnn layers, formatted as (num_kernels, kernel_size), '
@@ -242,9 +254,8 @@ def get_bayesian_network(topology, input_image, classes, mu_init, rho_init, prio
 
         features.append(l)
 
-    if isinstance(topology[-1], (tuple, list)):
-        input_image = torch.flatten(input_image, 1)
-        prev = input_image.shape[-1]
+    if ll_conv:
+        prev = int(np.prod(shape))
         features.append(Flatten())
 
     features.append(BayesianLinearLayer(in_size=prev, out_size=classes, mu_init=mu_init, rho_init=rho_init,
@@ -256,16 +267,15 @@ def get_bayesian_network(topology, input_image, classes, mu_init, rho_init, prio
 def get_network(topology, input_image, classes, bias=True):
     features = torch.nn.ModuleList()
 
-    prev = input_image.shape[0]
-    input_image = input_image.unsqueeze(0)
+    shape = tuple(input_image.shape)
+    prev = shape[0]
     ll_conv = False
 
     for j, i in enumerate(topology):
 
         if isinstance(i, (tuple, list)) and i[0] == 'MP':
             l = torch.nn.MaxPool2d(kernel_size=i[1], stride=i[2])
-            input_image = l(input_image)
-            prev = input_image.shape[1]
+            shape = _conv_output_shape(shape, prev, i[1], i[2])
             ll_conv = True
 
         elif isinstance(i, str) and i.lower() == 'relu':
@@ -276,8 +286,7 @@ def get_network(topology, input_image, classes, bias=True):
 
         elif isinstance(i, (tuple, list)) and i[0] == 'AP':
             l = torch.nn.AvgPool2d(kernel_size=i[1], stride=i[2])
-            input_image = l(input_image)
-            prev = input_image.shape[1]
+            shape = _conv_output_shape(shape, prev, i[1], i[2])
             ll_conv = True
 
         elif isinstance(i, (tuple, list)):
@@ -285,20 +294,20 @@ def get_network(topology, input_image, classes, bias=True):
             l = torch.nn.Conv2d(in_channels=prev, out_channels=size, stride=stride,
                                 kernel_size=kernel_size, bias=False, padding=padding)
 
-            input_image = l(input_image)
-            prev = input_image.shape[1]
+            shape = _conv_output_shape(shape, size, kernel_size, stride, padding)
+            prev = size
             ll_conv = True
 
         elif isinstance(i, int):
             if ll_conv:
-                input_image = torch.flatten(input_image, 1)
-                prev = input_image.shape[-1]
+                prev = int(np.prod(shape))
                 features.append(Flatten())
 
             ll_conv = False
             size = i
             l = torch.nn.Linear(prev, i, bias=bias)
             prev = size
+            shape = (size,)
         else:
             raise ValueError('Topology should be tuple for cnn layers, formatted as (num_kernels, kernel_size), '
                              'pooling layer, formatted as tuple ([\'MP\', \'AP\'], kernel_size, stride) '
@@ -307,8 +316,7 @@ def get_network(topology, input_image, classes, bias=True):
         features.append(l)
 
     if ll_conv:
-        input_image = torch.flatten(input_image, 1)
-        prev = input_image.shape[-1]
+        prev = int(np.prod(shape))
         features.append(Flatten())
 
     features.append(torch.nn.Linear(prev, classes))
@@ -358,15 +366,15 @@ class Wrapper(ABC):
         test_true = []
 
         self.model.eval()
-        with torch.no_grad():
+        with torch.inference_mode():
             for i, (x, y) in tqdm(enumerate(self.test_data), leave=False, total=len(self.test_data)):
-                x = x.to(self.device)
-                y = y.to(self.device)
+                x = x.to(self.device, non_blocking=True)
 
-                test_true.extend(y.tolist())
+                test_true.append(y)
 
-                out = self.model.eval_forward(x.to(self.device), samples=samples)
-                out = torch.mul(out, temperature)
+                out = self.model.eval_forward(x, samples=samples)
+                if temperature != 1:
+                    out = torch.mul(out, temperature)
 
                 out = torch.softmax(out, -1)
 
@@ -374,13 +382,20 @@ class Wrapper(ABC):
                     out = out.mean(0)
 
                 out = out.argmax(dim=-1)
-                test_pred.extend(out.tolist())
+                test_pred.append(out)
+
+        test_true = torch.cat(test_true).cpu().numpy()
+        test_pred = torch.cat(test_pred).cpu().numpy()
 
         return test_true, test_pred
 
     def shuffle_test(self, samples=1):
 
-        ts_copy = deepcopy(self.test_data.dataset.transform)
+        ts_copy = self.test_data.dataset.transform
+
+        # the transform is replaced once, each level only changes the shuffled percentage
+        pixel_shuffle = PixelShuffle(0)
+        self.test_data.dataset.transform = T.Compose([pixel_shuffle, ts_copy])
 
         HS = []
         DIFF = []
@@ -388,34 +403,34 @@ class Wrapper(ABC):
         self.model.eval()
 
         for n in tqdm(self.noise, desc='Pixel Shuffle test'):
-            ts = T.Compose([PixelShuffle(n), ts_copy])
-            self.test_data.dataset.transform = ts
+            pixel_shuffle.percentage = n
 
             H = []
             pred_label = []
             true_label = []
-            diff = []
 
             self.model.eval()
-            with torch.no_grad():
+            with torch.inference_mode():
                 for i, (x, y) in enumerate(self.test_data):
-                    true_label.extend(y.tolist())
+                    true_label.append(y)
+
+                    x = x.to(self.device, non_blocking=True)
 
-                    out = self.model.eval_forward(x.to(self.device), samples=samples)
+                    out = self.model.eval_forward(x, samples=samples)
 
-                    a, _ = epistemic_aleatoric_uncertainty(out)
-                    H.extend(a)
+                    # only the determinants are needed, and they are kept on the device until the end
+                    a, _ = _covariance(torch.softmax(out if out.dim() > 2 else out.unsqueeze(0), 2))
+                    H.append(a)
 
                     if out.dim() > 2:
                         out = out.mean(0)
 
-                    out = torch.softmax(out, -1)
-                    pred_label.extend(out.argmax(dim=-1).tolist())
-
-                    top_score, top_label = torch.topk(out, 2)
+                    pred_label.append(out.argmax(dim=-1))
 
-                    diff.extend(((top_score[:, 0] - top_score[:, 1]) ** 2).tolist())
+            true_label = torch.cat(true_label).numpy()
+            pred_label = torch.cat(pred_label).cpu().numpy()
 
+            H = torch.cat(H).cpu().numpy()
             H = -np.log(np.mean(H))
 
             HS.append(H)
@@ -433,201 +448,187 @@ class Wrapper(ABC):
         correctly_predicted_h = []
         wrongly_predicted_h = []
 
+        # one row per epsilon, filled while iterating the test set only once
+        n = len(self.test_data.sampler)
+        H = torch.empty((len(self.epsilons), n), device=self.device)
+        He = torch.empty_like(H)
+        pred_label = torch.empty((len(self.epsilons), n), dtype=torch.long, device=self.device)
+        true_label = torch.empty(n, dtype=torch.long)
+        start = 0
+
         self.model.eval()
         loss = cross_entropy_loss('mean')
 
-        for eps in tqdm(self.epsilons, desc='Attack test', leave=False):
+        # only the gradient w.r.t. the input is needed, so no gradient buffer is allocated for the parameters
+        requires_grad = [p.requires_grad for p in self.model.parameters()]
+        self.model.requires_grad_(False)
 
-            H = []
-            He = []
-            pred_label = []
-            true_label = []
+        try:
+            for i, (x, y) in tqdm(enumerate(self.test_data), desc='Attack test', leave=False,
+                                  total=len(self.test_data)):
+                end = start + len(y)
+                true_label[start:end] = y
 
-            self.model.eval()
-            for i, (x, y) in enumerate(self.test_data):
-                true_label.extend(y.tolist())
-
-                x = x.to(self.device)
-                y = y.to(self.device)
+                x = x.to(self.device, non_blocking=True)
+                y = y.to(self.device, non_blocking=True)
 
-                self.model.zero_grad()
                 x.requires_grad = True
 
-                out = self.model.eval_forward(x.to(self.device), samples=1)
+                out = self.model.eval_forward(x, samples=1)
                 ce = loss(out, y)
-                ce.backward()
-
-                with torch.no_grad():
-                    perturbed_data = fgsm_attack(x, eps)
 
-                    out = self.model.eval_forward(perturbed_data, samples=samples)
+                # the gradient sign does not depend on epsilon, so it is shared by all the attacks;
+                # being just -1, 0 or 1 it is stored as int8
+                sign_data_grad = torch.autograd.grad(ce, x)[0].sign().to(torch.int8)
+                x = x.detach()
 
-                    a, _ = epistemic_aleatoric_uncertainty(out)
-                    H.extend(a)
+                with torch.inference_mode():
+                    for j, eps in enumerate(self.epsilons):
+                        perturbed_data = fgsm_attack(x, sign_data_grad, eps)
 
-                    a, _ = entropy(out)
-                    He.extend(a)
-
-                    out = torch.softmax(out, -1)
-                    if out.dim() > 2:
-                        out = out.mean(0)
+                        out = self.model.eval_forward(perturbed_data, samples=samples)
 
-                    pred_label.extend(out.argmax(dim=-1).tolist())
+                        a, _, e = uncertainties(out)
+                        H[j, start:end] = a
+                        He[j, start:end] = e
 
-            _correctly_predicted = []
-            _wrongly_predicted = []
+                        out = torch.softmax(out, -1)
+                        if out.dim() > 2:
+                            out = out.mean(0)
 
-            for i in range(len(true_label)):
-                if true_label[i] == pred_label[i]:
-                    _correctly_predicted.append(H[i])
-                else:
-                    _wrongly_predicted.append(H[i])
+                        pred_label[j, start:end] = out.argmax(dim=-1)
 
-            correctly_predicted.append(_correctly_predicted)
-            wrongly_predicted.append(_wrongly_predicted)
+                start = end
+        finally:
+            for p, r in zip(self.model.parameters(), requires_grad):
+                p.requires_grad_(r)
 
-            _correctly_predicted = []
-            _wrongly_predicted = []
+        H = H.cpu().numpy()
+        He = He.cpu().numpy()
+        correct = true_label.numpy() == pred_label.cpu().numpy()
 
-            for i in range(len(true_label)):
-                if true_label[i] == pred_label[i]:
-                    _correctly_predicted.append(He[i])
-                else:
-                    _wrongly_predicted.append(He[i])
+        for j in range(len(self.epsilons)):
+            correctly_predicted.append(H[j][correct[j]].tolist())
+            wrongly_predicted.append(H[j][~correct[j]].tolist())
 
-            correctly_predicted_h.append(_correctly_predicted)
-            wrongly_predicted_h.append(_wrongly_predicted)
+            correctly_predicted_h.append(He[j][correct[j]].tolist())
+            wrongly_predicted_h.append(He[j][~correct[j]].tolist())
 
         return (correctly_predicted, wrongly_predicted), (correctly_predicted_h, wrongly_predicted_h)
 
     def white_noise_test(self, samples=1):
 
-        ts_copy = deepcopy(self.test_data.dataset.transform)
-
         correctly_predicted = []
         wrongly_predicted = []
 
         correctly_predicted_h = []
         wrongly_predicted_h = []
 
-        self.model.eval()
-        with torch.no_grad():
-
-            for eps in tqdm(self.noise, desc='White noise test', leave=False):
+        # one row per noise level
+        n = len(self.test_data.sampler)
+        H = torch.empty((len(self.noise), n), device=self.device)
+        He = torch.empty_like(H)
+        pred_label = torch.empty((len(self.noise), n), dtype=torch.long, device=self.device)
+        true_label = torch.empty(n, dtype=torch.long)
 
-                ts = T.Compose([ts_copy, AddNoise(eps)])
-                self.test_data.dataset.transform = ts
+        self.model.eval()
+        with torch.inference_mode():
 
-                H = []
-                He = []
-                pred_label = []
-                true_label = []
+            for j, eps in enumerate(tqdm(self.noise, desc='White noise test', leave=False)):
 
+                start = 0
                 for i, (x, y) in enumerate(self.test_data):
-                    true_label.extend(y.tolist())
+                    end = start + len(y)
+                    true_label[start:end] = y
 
-                    x = x.to(self.device)
+                    x = x.to(self.device, non_blocking=True)
+                    if eps > 0:
+                        x = x + eps * torch.randn_like(x)
 
                     out = self.model.eval_forward(x, samples=samples)
 
-                    a, _ = epistemic_aleatoric_uncertainty(out)
-                    H.extend(a)
-
-                    a, _ = entropy(out)
-                    He.extend(a)
+                    a, _, e = uncertainties(out)
+                    H[j, start:end] = a
+                    He[j, start:end] = e
 
                     out = torch.softmax(out, -1)
                     if out.dim() > 2:
                         out = out.mean(0)
 
-                    pred_label.extend(out.argmax(dim=-1).tolist())
+                    pred_label[j, start:end] = out.argmax(dim=-1)
 
-                _correctly_predicted = []
-                _wrongly_predicted = []
+                    start = end
 
-                for i in range(len(true_label)):
-                    if true_label[i] == pred_label[i]:
-                        _correctly_predicted.append(H[i])
-                    else:
-                        _wrongly_predicted.append(H[i])
+        H = H.cpu().numpy()
+        He = He.cpu().numpy()
+        correct = true_label.numpy() == pred_label.cpu().numpy()
 
-                correctly_predicted.append(_correctly_predicted)
-                wrongly_predicted.append(_wrongly_predicted)
+        for j in range(len(self.noise)):
+            correctly_predicted.append(H[j][correct[j]].tolist())
+            wrongly_predicted.append(H[j][~correct[j]].tolist())
 
-                _correctly_predicted = []
-                _wrongly_predicted = []
-
-                for i in range(len(true_label)):
-                    if true_label[i] == pred_label[i]:
-                        _correctly_predicted.append(He[i])
-                    else:
-                        _wrongly_predicted.append(He[i])
-
-                correctly_predicted_h.append(_correctly_predicted)
-                wrongly_predicted_h.append(_wrongly_predicted)
-
-        self.test_data.dataset.transform = ts_copy
+            correctly_predicted_h.append(He[j][correct[j]].tolist())
+            wrongly_predicted_h.append(He[j][~correct[j]].tolist())
 
         return (correctly_predicted, wrongly_predicted), (correctly_predicted_h, wrongly_predicted_h)
 
-    def reliability_diagram(self, samples=1, bins=15, scaling=1, **kwargs):
+    def test_logits(self, samples=1):
 
-        y_prob = []
-        y_true = []
-        y_pred = []
+        logits = []
+        labels = []
 
         self.model.eval()
         with torch.no_grad():
             for i, (x, y) in enumerate(self.test_data):
-                y_true.extend(y.tolist())
-                x = x.to(self.device)
-
-                out = self.model.eval_forward(x.to(self.device), samples=samples)
+                x = x.to(self.device, non_blocking=True)
 
-                if hasattr(out, '__call__') and hasattr(out, 'sample'):
-                    scaling = out.sample(out.size()[-1])
+                out = self.model.eval_forward(x, samples=samples)
 
                 if out.dim() > 2:
                     out = out.mean(0)
 
-                out = torch.softmax(out, -1)
-                out = torch.div(out, scaling)
+                logits.append(out)
+                labels.append(y)
 
-                prob, pred = torch.topk(out, 1, -1)
-                y_prob.extend(prob.tolist())
-                y_pred.extend(pred.tolist())
+        return torch.cat(logits), torch.cat(labels)
 
-        y_true = np.asarray(y_true)[:, None]
-        y_prob = np.asarray(y_prob)
-        y_pred = np.asarray(y_pred)
+    def reliability_diagram(self, samples=1, bins=15, scaling=1, cached_logits=None, **kwargs):
 
-        prob_pred = np.empty((0,))
-        prob_true = np.zeros((0,))
-        ece = 0
-        nll = -np.sum(np.log(y_prob))
+        if cached_logits is None:
+            cached_logits = self.test_logits(samples=samples)
 
-        mce = []
+        logits, labels = cached_logits
 
-        for b in range(1, int(bins) + 1):
-            i = np.logical_and(y_prob <= b / bins, y_prob > (b - 1) / bins)  # indexes for p in the current bin
+        if scaling != 1:
+            logits = torch.div(logits, scaling)
 
-            s = np.sum(i)
+        out = torch.softmax(logits, -1)
+        prob, pred = torch.topk(out, 1, -1)
 
-            if s == 0:
-                prob_pred = np.hstack((prob_pred, 0))
-                prob_true = np.hstack((prob_true, 0))
-                continue
+        y_true = labels.cpu().numpy()[:, None]
+        y_prob = prob.cpu().numpy().astype(np.float64)
+        y_pred = pred.cpu().numpy()
 
-            m = 1 / s
-            acc = m * np.sum(y_pred[i] == y_true[i])
-            conf = np.mean(y_prob[i])
+        nll = -np.sum(np.log(y_prob))
+
+        bins = int(bins)
+        y_prob = y_prob.ravel()
+        correct = (y_pred == y_true).ravel()
+
+        # bin b holds the probabilities in ((b - 1) / bins, b / bins]
+        bin_id = np.digitize(y_prob, np.arange(bins + 1) / bins, right=True) - 1
+        in_range = np.logical_and(bin_id >= 0, bin_id < bins)
+        bin_id = bin_id[in_range]
 
-            prob_pred = np.hstack((prob_pred, conf))
-            prob_true = np.hstack((prob_true, acc))
+        counts = np.bincount(bin_id, minlength=bins)
+        correct_sum = np.bincount(bin_id, weights=correct[in_range], minlength=bins)
+        prob_sum = np.bincount(bin_id, weights=y_prob[in_range], minlength=bins)
 
-            mce.append(np.abs(acc - conf))
+        non_empty = counts > 0
+        prob_true = np.where(non_empty, correct_sum / np.maximum(counts, 1), 0)
+        prob_pred = np.where(non_empty, prob_sum / np.maximum(counts, 1), 0)
 
-            ece += (s / len(y_true)) * np.abs(acc - conf)
+        ece = np.sum((counts / len(y_true)) * np.abs(prob_true - prob_pred))
 
         return prob_pred, prob_true, ece, nll
 
@@ -636,9 +637,9 @@ class Wrapper(ABC):
         M = []
 
         self.model.eval()
-        with torch.no_grad():
+        with torch.inference_mode():
             for i, (x, y) in enumerate(self.test_data):
-                x = x.to(self.device)
+                x = x.to(self.device, non_blocking=True)
                 out = self.model.eval_forward(x, samples=samples)
 
                 _, m = epistemic_aleatoric_uncertainty(out)
@@ -656,33 +657,22 @@ class Wrapper(ABC):
 
         optimizer = optim.Adam([temperature], lr=0.1)
 
-        outs = torch.tensor([], dtype=torch.long, requires_grad=False)
-
-        best_ece = self.reliability_diagram(samples=1)[-2]
-
-        for i, (x, y) in enumerate(self.test_data):
-            optimizer.zero_grad()
-
-            out = self.model.eval_forward(x.to(self.device), samples=1)
-
-            if out.dim() > 2:
-                out = out.mean(0)
-
-            out = torch.softmax(out, -1)
-            _, pred = torch.topk(out, 1, -1)
+        # the temperature only rescales the logits, so the model is evaluated once
+        logits, labels = self.test_logits(samples=samples)
+        cached_logits = (logits, labels)
+        labels = labels.to(self.device)
 
-            outs = torch.cat((outs, pred.cpu()))
+        best_ece = self.reliability_diagram(cached_logits=cached_logits)[-2]
 
         for i in range(100):
 
             optimizer.zero_grad()
-            _outs = torch.div(outs.to(self.device), temperature)
 
-            loss = torch.sum(torch.log(_outs + 1e-12))
+            loss = F.cross_entropy(torch.div(logits, temperature), labels)
             loss.backward()
             optimizer.step()
 
-            _, _, ece, _ = self.reliability_diagram(samples=samples, scaling=temperature.item())
+            _, _, ece, _ = self.reliability_diagram(scaling=temperature.item(), cached_logits=cached_logits)
 
             if ece < best_ece:
                 best_ece = ece
@@ -5,6 +5,7 @@ from torch import nn as nn
 from torch.nn import functional as F
 
 from bayesian_utils import compute_mmd, BayesianParameters
+from priors import Gaussian
 
 
 class BayesianLayer(ABC, nn.Module):
@@ -35,9 +36,20 @@ class BayesianLayer(ABC, nn.Module):
 
         self.prior_w = prior
         self.prior_b = prior
+        self._prior_w_sample = None
+        self._prior_b_sample = None
+        self._prior_ready = False
         self.log_prior = None
         self.log_posterior = None
 
+    def _apply(self, fn, *args, **kwargs):
+        super()._apply(fn, *args, **kwargs)
+        # keep the priors on the same device as the parameters, so that sampling and log_prob don't cross devices
+        for prior in (self.prior_w, self.prior_b):
+            if prior is not None:
+                prior.to(self.w.mu.device)
+        return self
+
     def _mmd_forward(self, x, calculate_divergence):
         o, w, b = self._forward(x)
 
@@ -45,13 +57,26 @@ class BayesianLayer(ABC, nn.Module):
         mmd_b = torch.tensor(0.0).to(x.device)
 
         if self.training and calculate_divergence:
-            w = torch.flatten(w, 1)
-            mmd_w = compute_mmd(w, self.prior_w.sample(w.size()).to(w.device), type=self.kernel, biased=self.biased)
-
-            if b is not None:
-                b = b.unsqueeze(0)
-                mmd_b = compute_mmd(b, self.prior_b.sample(b.size()).to(w.device), type=self.kernel,
+            if w is None:
+                # with the local reparametrization no weights are sampled, so the activations are compared with
+                # the ones of the same input through the prior
+                with torch.no_grad():
+                    prior_o = self._prior_forward(x)
+                mmd_w = compute_mmd(torch.flatten(o, 1), torch.flatten(prior_o, 1), type=self.kernel,
                                     biased=self.biased)
+            else:
+                w = torch.flatten(w, 1)
+                if not self._prior_ready:
+                    self._prior_w_sample = self._prior_sample(self.prior_w, w)
+                mmd_w = compute_mmd(w, self._prior_w_sample, type=self.kernel, biased=self.biased)
+
+                if b is not None:
+                    b = b.unsqueeze(0)
+                    if not self._prior_ready:
+                        self._prior_b_sample = self._prior_sample(self.prior_b, b)
+                    mmd_b = compute_mmd(b, self._prior_b_sample, type=self.kernel, biased=self.biased)
+
+            self._prior_ready = False
 
             if self.alpha is not None:
                 if torch.abs(mmd_b) < self.alpha:
@@ -61,20 +86,72 @@ class BayesianLayer(ABC, nn.Module):
 
         return o, mmd_w + mmd_b
 
+    @staticmethod
+    def _prior_sample(prior, x):
+        # the prior is sampled directly on the parameters' device, into a new tensor at every call since autograd
+        # keeps the sample for the backward of compute_mmd
+        return prior.sample_(torch.empty_like(x, requires_grad=False))
+
+    def _gaussian_priors(self):
+        return isinstance(self.prior_w, Gaussian) and (self.b is None or isinstance(self.prior_b, Gaussian))
+
+    def _prior_forward(self, x):
+        if self._gaussian_priors():
+            # the prior weights are i.i.d. gaussians, so every unit has the same activation mean and variance,
+            # obtained from x and x^2 through a single all-ones filter, and the activations are sampled from them
+            ones = x.new_ones((1,) + self.w.mu.shape[1:])
+            mean = self._apply_weights(x, ones).mul_(self.prior_w.mu)
+            var = self._apply_weights(x.pow(2), ones).mul_(self.prior_w.sigma ** 2)
+            if self.b is not None:
+                mean.add_(self.prior_b.mu)
+                var.add_(self.prior_b.sigma ** 2)
+
+            size = list(mean.shape)
+            size[1] = self.w.mu.shape[0]
+            return torch.addcmul(mean, var.sqrt_(), torch.randn(size, device=x.device, dtype=x.dtype))
+
+        if not self._prior_ready:
+            self._prior_w_sample = self._prior_sample(self.prior_w, self.w.mu)
+        b = None
+        if self.b is not None:
+            if not self._prior_ready:
+                self._prior_b_sample = self._prior_sample(self.prior_b, self.b.mu)
+            b = self._prior_b_sample
+        return self._apply_weights(x, self._prior_w_sample, b)
+
+    def _prior_shapes(self):
+        # shapes of the prior samples compared with the flattened parameters, or used as layer weights by the
+        # local reparametrization when the priors are not gaussian
+        if self.local_trick and self._gaussian_priors():
+            return []
+
+        w_shape = self.w.mu.shape if self.local_trick else (self.w.mu.shape[0], self.w.mu[0].numel())
+        shapes = [('_prior_w_sample', self.prior_w, torch.Size(w_shape))]
+        if self.b is not None:
+            b_shape = self.b.mu.shape if self.local_trick else (1, self.b.mu.shape[0])
+            shapes.append(('_prior_b_sample', self.prior_b, torch.Size(b_shape)))
+        return shapes
+
+    @staticmethod
+    def _kl(parameters, prior, x):
+        # closed form when both distributions are gaussian, monte carlo estimate on the sample otherwise
+        if isinstance(prior, Gaussian):
+            return parameters.kl_to_gaussian_prior(prior.mu, prior.sigma).sum()
+        if x is None:
+            x = parameters.weights
+        return (parameters.posterior_log_prob(x) - prior.log_prob(x)).sum()
+
     def _kl_forward(self, x, calculate_divergence):
         o, w, b = self._forward(x)
-        log_post = torch.tensor(0.0)
-        log_prior = torch.tensor(0.0)
+        kl = torch.tensor(0.0, device=x.device)
 
         if self.training and calculate_divergence:
-            log_post = self.w.posterior_log_prob(w).sum()
-            log_prior = self.prior_w.log_prob(w).sum()
+            kl = self._kl(self.w, self.prior_w, w)
 
             if b is not None:
-                log_post += self.b.posterior_log_prob(b).sum()
-                log_prior += self.prior_b.log_prob(b).sum()
+                kl = kl + self._kl(self.b, self.prior_b, b)
 
-        return o, log_prior, log_post
+        return o, kl
 
     def forward(self, x, calculate_divergence=True):
         if self.divergence == 'kl':
@@ -101,11 +178,36 @@ class BayesianLayer(ABC, nn.Module):
 
         return w_log + b_log
 
+    @abstractmethod
+    def _apply_weights(self, x, w, b=None):
+        pass
+
     @abstractmethod
     def _forward(self, x):
         pass
 
 
+def sample_all_priors(layers):
+    # the prior samples of all the layers that share a prior come from a single draw, and each layer receives a
+    # view on its slice; the samples are used by the next divergence computed by each layer
+    requests = {}
+    for layer in layers:
+        if isinstance(layer, BayesianLayer) and layer.divergence == 'mmd':
+            for name, prior, shape in layer._prior_shapes():
+                requests.setdefault(id(prior), (prior, []))[1].append((layer, name, shape))
+            layer._prior_ready = True
+
+    for prior, items in requests.values():
+        mu = items[0][0].w.mu
+        samples = torch.empty(sum(shape.numel() for _, _, shape in items), device=mu.device, dtype=mu.dtype)
+        prior.sample_(samples)
+
+        offset = 0
+        for layer, name, shape in items:
+            setattr(layer, name, samples[offset:offset + shape.numel()].view(shape))
+            offset += shape.numel()
+
+
 class BayesianCNNLayer(BayesianLayer):
     def __init__(self, in_channels, kernels, divergence, kernel_size=3, stride=1, padding=0, dilation=1, groups=1,
                  mu_init=None, rho_init=None, local_rep_trick=False, prior=None, posterior_type='weights', **kwargs):
@@ -121,20 +223,23 @@ class BayesianCNNLayer(BayesianLayer):
                                     posterior_type=posterior_type,
                                     mu_initialization=mu_init, rho_initialization=rho_init)
 
+    def _apply_weights(self, x, w, b=None):
+        return F.conv2d(x, weight=w, bias=b, stride=self.stride, padding=self.padding)
+
     def _forward(self, x):
 
         b = None
         if not self.local_trick:
             w = self.w.weights
-            o = F.conv2d(x, weight=w, stride=self.stride, padding=self.padding)
+            o = self._apply_weights(x, w)
             return o, w, b
         else:
-            w_mu = F.conv2d(x, weight=self.w.mu)
-            w_std = torch.sqrt(1e-12 + F.conv2d(x.pow(2), weight=self.w.sigma))
+            w_mu = self._apply_weights(x, self.w.mu)
+            w_std = self._apply_weights(x.pow(2), self.w.sigma).add_(1e-12).sqrt_()
 
-            output = w_mu + w_std * torch.randn(w_std.size(), requires_grad=True).to(w_std.device)
+            output = torch.addcmul(w_mu, w_std, torch.randn_like(w_std))
 
-            return output, self.w.weights, b
+            return output, None, b
 
     def extra_repr(self):
         return 'input: {}, output: {}, kernel_size: {}, bias: {}'.format(self.in_channels, self.kernels,
@@ -159,26 +264,29 @@ class BayesianLinearLayer(BayesianLayer):
             self.b = BayesianParameters(size=out_size, mu_initialization=mu_init, is_bias=True,
                                         rho_initialization=rho_init, posterior_type=posterior_type)
 
+    def _apply_weights(self, x, w, b=None):
+        return F.linear(x, w, b)
+
     def _forward(self, x):
         b = None
         if not self.local_trick:
             w = self.w.weights
             if self.b is not None:
                 b = self.b.weights
-            o = F.linear(x, w, b)
+            o = self._apply_weights(x, w, b)
             return o, w, b
         else:
-            w_mu = F.linear(input=x, weight=self.w.mu)
+            w_mu = self._apply_weights(x, self.w.mu)
 
-            w_std = torch.sqrt(1e-12 + F.linear(input=x.pow(2), weight=self.w.sigma))
+            w_std = self._apply_weights(x.pow(2), self.w.sigma).add_(1e-12).sqrt_()
 
-            w_out = w_mu + w_std * torch.randn(w_mu.shape, requires_grad=True).to(x.device)
+            w_out = torch.addcmul(w_mu, w_std, torch.randn_like(w_mu))
 
             if self.b is not None:
                 b = self.b.weights
                 w_out += b.unsqueeze(0).expand(x.shape[0], -1)
 
-            return w_out, self.w.weights, b
+            return w_out, None, b
 
     def extra_repr(self):
         return 'input: {}, output: {}, bias: {}'.format(self.in_size, self.out_size,
@@ -1,4 +1,5 @@
-import numpy as np
+import math
+from typing import List, Optional
 
 from torch import nn as nn
 from torch.distributions import Normal
@@ -15,10 +16,10 @@ class BayesianParameters(nn.Module):
         if mu_initialization is None:
             t = torch.empty(size)
             if is_bias:
-                bound = 1 / np.sqrt(size)
+                bound = 1 / math.sqrt(size)
                 init.uniform_(t, -bound, bound)
             else:
-                init.kaiming_uniform_(t, a=np.sqrt(5))
+                init.kaiming_uniform_(t, a=math.sqrt(5))
             self.mu = nn.Parameter(t, requires_grad=True)
 
         else:
@@ -26,12 +27,12 @@ class BayesianParameters(nn.Module):
 
             if t == 'uniform':
                 a, b = mu_initialization['a'], mu_initialization['b']
-                self.mu = nn.Parameter(torch.zeros(size).uniform_(a, b), requires_grad=True)
+                self.mu = nn.Parameter(torch.empty(size).uniform_(a, b), requires_grad=True)
             elif t == 'gaussian':
                 mu, sigma = mu_initialization['mu'], mu_initialization['sigma']
-                self.mu = nn.Parameter(torch.zeros(size).normal_(mu, sigma), requires_grad=True)
+                self.mu = nn.Parameter(torch.empty(size).normal_(mu, sigma), requires_grad=True)
             elif t == 'constant':
-                self.mu = nn.Parameter(torch.ones(size) * mu_initialization['c'], requires_grad=True)
+                self.mu = nn.Parameter(torch.empty(size).fill_(mu_initialization['c']), requires_grad=True)
             else:
                 raise ValueError("Pissible initialization for mu parameter: \n"
                                  "-gaussian {{mu, sigma}}\n"
@@ -57,12 +58,12 @@ class BayesianParameters(nn.Module):
 
             if t == 'uniform':
                 a, b = rho_initialization['a'], rho_initialization['b']
-                rho = torch.zeros(rho_size).uniform_(a, b)
+                rho = torch.empty(rho_size).uniform_(a, b)
             elif t == 'gaussian':
                 mu, sigma = rho_initialization['mu'], rho_initialization['sigma']
-                rho = torch.zeros(rho_size).normal_(mu, sigma)
+                rho = torch.empty(rho_size).normal_(mu, sigma)
             elif t == 'constant':
-                rho = torch.ones(rho_size) * rho_initialization['c']
+                rho = torch.empty(rho_size).fill_(rho_initialization['c'])
             else:
                 raise ValueError("Pissible initialization for rho parameter: \n"
                                  "-gaussian {{mu, sigma}}\n"
@@ -80,30 +81,36 @@ class BayesianParameters(nn.Module):
     @property
     def weights(self):
         sigma = self.sigma
-        r = self.mu + sigma * torch.randn(self.mu.shape, requires_grad=True).to(self.mu.device)
+        r = torch.addcmul(self.mu, sigma, torch.randn_like(self.mu))
 
         if self.mask is not None:
-            mean = torch.abs(self.mu)
-            std = self.sigma
-            snr = mean / std
-            percentile = np.percentile(snr.cpu(), self.mask * 100)
+            snr = torch.abs(self.mu) / sigma
+            percentile = torch.quantile(snr.detach().flatten(), self.mask)
             mask = torch.ones_like(snr)
-            mask[snr < torch.tensor(percentile)] = 0
+            mask[snr < percentile] = 0
             r = r * mask
 
         return r
 
+    def _sigma(self):
+        return F.softplus(self.rho)
+
     @property
     def sigma(self):
         if self.posterior_type == 'weights':
-            return F.softplus(self.rho)
+            return self._sigma()
         if self.posterior_type == 'multiplicative':
-            return torch.mul(F.softplus(self.rho), self.mu.pow(2))
+            return torch.mul(self._sigma(), self.mu.pow(2))
         else:
-            return torch.mul(F.softplus(self.rho), self.mu.pow(2))
+            return torch.mul(self._sigma(), self.mu.pow(2))
+
+    def kl_to_gaussian_prior(self, mu_p, sigma_p):
+        sigma = self.sigma
+        return math.log(sigma_p) - torch.log(sigma) + \
+            (sigma.pow(2) + (self.mu - mu_p).pow(2)) / (2 * sigma_p ** 2) - 0.5
 
     def posterior_distribution(self):
-        return Normal(self.mu.data.clone(), torch.log(1 + torch.exp(self.rho)).clone())
+        return Normal(self.mu.data.clone(), self._sigma())
 
     def posterior_log_prob(self, w):
         return self.posterior_distribution().log_prob(w)
@@ -116,72 +123,65 @@ def b_drop(x, p=0.5):
     return F.dropout(x, p=p, training=True, inplace=False)
 
 
-def pdist(p, q):
-    pdim, qdim = p.size(0), q.size(0)
-    pnorm = torch.sum(p ** 2, dim=1, keepdim=True)
-    qnorm = torch.sum(q ** 2, dim=1, keepdim=True)
-    norms = (pnorm.expand(pdim, qdim) +
-             qnorm.transpose(0, 1).expand(pdim, qdim))
-    distances_squared = norms - 2 * p.mm(q.t())
-    return torch.sqrt(1e-5 + torch.abs(distances_squared))
-
-
-def pairwise_distances(x, y):
-    x_norm = (x ** 2).sum(1).view(-1, 1)
-    y_norm = (y ** 2).sum(1).view(1, -1)
-
-    dist = x_norm + y_norm - 2.0 * torch.mm(x, torch.transpose(y, 0, 1))
-    return torch.clamp(dist, 0.0, np.inf)
+@torch.jit.script
+def _squared_distances(a: torch.Tensor, b: torch.Tensor) -> torch.Tensor:
+    # |a|^2 + |b|^2 - 2 a b^T, whose backward only needs matrix products
+    d = torch.addmm(b.pow(2).sum(1), a, b.T, alpha=-2.0)
+    return d.add_(a.pow(2).sum(1, keepdim=True)).clamp_min_(0.0)
 
 
-def compute_mmd(x, y, type='inverse', biased=True, space=None, max=False):
-    d = x.device
-
-    xs = x.shape[0]
-    XX, YY, XY = torch.zeros([xs, xs]).to(d), torch.zeros([xs, xs]).to(d), torch.zeros([xs, xs]).to(d)
-    xxd = pdist(x, x) ** 2
-    yyd = pdist(y, y) ** 2
-    xyd = pdist(x, y) ** 2
+@torch.jit.script
+def _kernel(d: torch.Tensor, type: str, space: List[float]) -> torch.Tensor:
+    k = torch.zeros_like(d)
 
     if type == 'rbf':
-
-        if space is None:
-            space = [0.5, 1, 2, 4, 8, 16]
-
         for gamma in space:
             gamma = 1.0 / (2 * gamma ** 2)
+            k += torch.mul(d, -gamma).exp_()
+    else:
+        for a in space:
+            a = a ** 2
+            k += torch.add(d, a).rsqrt_()
 
-            xx = torch.exp(-xxd * gamma)
-            yy = torch.exp(-yyd * gamma)
-            xy = torch.exp(-xyd * gamma)
+    return k
 
-            XX += xx
-            YY += yy
-            XY += xy
 
+@torch.jit.script
+def compute_mmd(x: torch.Tensor, y: torch.Tensor, type: str = 'inverse', biased: bool = True,
+                space: Optional[List[float]] = None, max: bool = False, chunk_size: int = 512) -> Optional[torch.Tensor]:
+    if type == 'rbf':
+        if space is None:
+            space = [0.5, 1.0, 2.0, 4.0, 8.0, 16.0]
     elif type == 'inverse':
-
         if space is None:
-            space = [0.05, 0.2, 0.6, 0.9, 1]
-
-        for a in space:
-            a = a ** 2
-            xxk = torch.div(1, torch.sqrt(a + xxd))
-            yyk = torch.div(1, torch.sqrt(a + yyd))
-            xyk = torch.div(1, torch.sqrt(a + xyd))
-
-            XX += xxk
-            YY += yyk
-            XY += xyk
+            space = [0.05, 0.2, 0.6, 0.9, 1.0]
     else:
         return None
 
+    xs, ys = x.shape[0], y.shape[0]
+    XX, YY, XY = x.new_zeros(()), x.new_zeros(()), x.new_zeros(())
+    XX_trace, YY_trace = x.new_zeros(()), x.new_zeros(())
+
+    # the kernel matrices are reduced chunk_size rows at a time, so that none of them is fully materialized
+    for i in range(0, xs, chunk_size):
+        k = _kernel(_squared_distances(x[i:i + chunk_size], x), type, space)
+        XX = XX + k.sum()
+        if not biased:
+            XX_trace = XX_trace + torch.diagonal(k[:, i:i + chunk_size]).sum()
+
+        XY = XY + _kernel(_squared_distances(x[i:i + chunk_size], y), type, space).sum()
+
+    for i in range(0, ys, chunk_size):
+        k = _kernel(_squared_distances(y[i:i + chunk_size], y), type, space)
+        YY = YY + k.sum()
+        if not biased:
+            YY_trace = YY_trace + torch.diagonal(k[:, i:i + chunk_size]).sum()
+
     if biased:
-        mmd = XX.mean() + YY.mean() - 2 * XY.mean()
+        mmd = XX / (xs ** 2) + YY / (ys ** 2) - 2 * XY / (xs * ys)
     else:
-        XX = XX.sum() - XX.trace()
-        YY = YY.sum() - YY.trace()
-        XY = XY.sum()
+        XX = XX - XX_trace
+        YY = YY - YY_trace
         mmd = (1 / (xs ** 2)) * XX + (1 / (xs ** 2)) * YY - (2 / (xs * xs)) * XY
 
     return F.relu(mmd)
@@ -94,9 +94,14 @@ def get_dataset(name, batch_size, dev_split, resize=None, train_subset=0):
         sampler = SubsetRandomSampler(idx)
         shuffle = False
 
-    train_loader = torch.utils.data.DataLoader(train_split, batch_size=batch_size, shuffle=shuffle, sampler=sampler)
+    # page-locked batches allow asynchronous (non_blocking) copies to the gpu
+    pin_memory = torch.cuda.is_available()
 
-    test_loader = torch.utils.data.DataLoader(test_split, batch_size=batch_size, shuffle=False)
+    train_loader = torch.utils.data.DataLoader(train_split, batch_size=batch_size, shuffle=shuffle, sampler=sampler,
+                                               pin_memory=pin_memory)
+
+    test_loader = torch.utils.data.DataLoader(test_split, batch_size=batch_size, shuffle=False,
+                                              pin_memory=pin_memory)
 
     return sample, classes, train_loader, test_loader
 
@@ -65,9 +65,13 @@ def get_dataset(batch_size, regression_points, points_range, variance, noise):
     test_dataset = RegressionDataset(x[test_idx],
                                      y[test_idx])
 
-    train_loader = torch.utils.data.DataLoader(train_dataset, batch_size=batch_size, shuffle=True)
+    pin_memory = torch.cuda.is_available()
 
-    test_loader = torch.utils.data.DataLoader(test_dataset, batch_size=batch_size, shuffle=False)
+    train_loader = torch.utils.data.DataLoader(train_dataset, batch_size=batch_size, shuffle=True,
+                                               pin_memory=pin_memory)
+
+    test_loader = torch.utils.data.DataLoader(test_dataset, batch_size=batch_size, shuffle=False,
+                                              pin_memory=pin_memory)
 
     return train_loader, test_loader, train_dataset[0][0]
 
@@ -243,7 +247,7 @@ def main(experiment):
                                           weights=loss_weights)
                 progress_bar.set_postfix(loss=np.mean(loss))
 
-            with torch.no_grad():
+            with torch.inference_mode():
                 dist = np.abs(points_range[0] - points_range[1]) // 2
                 x_true = torch.linspace(points_range[0] - dist, points_range[1] + dist, 500)
                 pred = t.model.eval_forward(x_true[:, None].to(device), samples=test_samples)
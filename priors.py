@@ -1,3 +1,5 @@
+import math
+
 import torch
 from torch.distributions import Normal
 
@@ -11,6 +13,14 @@ class Gaussian(object):
     def sample(self, size):
         return self.inner_gaussian.rsample(size)
 
+    def sample_(self, out):
+        return out.normal_(self.mu, self.sigma)
+
+    def to(self, device):
+        self.inner_gaussian = Normal(torch.tensor(float(self.mu), device=device),
+                                     torch.tensor(float(self.sigma), device=device))
+        return self
+
     def log_prob(self, x):
         return self.inner_gaussian.log_prob(x)
 
@@ -24,6 +34,14 @@ class Laplace(object):
     def sample(self, size):
         return self.distribution.rsample(size)
 
+    def sample_(self, out):
+        return out.copy_(self.distribution.sample(out.shape))
+
+    def to(self, device):
+        self.distribution = torch.distributions.laplace.Laplace(torch.tensor(float(self.mu), device=device),
+                                                                torch.tensor(float(self.scale), device=device))
+        return self
+
     def log_prob(self, x):
         return self.distribution.log_prob(x)
 
@@ -37,9 +55,20 @@ class ScaledMixtureGaussian(object):
         self.mu2 = mu2
         self.gaussian1 = Gaussian(mu1, s1)
         self.gaussian2 = Gaussian(mu2, s2)
+        # pi * g1 + (1 - pi) * g2 is itself a gaussian, so it is sampled with a single draw
+        self.weighted_gaussian = Gaussian(pi * mu1 + (1 - pi) * mu2, math.sqrt((pi * s1) ** 2 + ((1 - pi) * s2) ** 2))
 
     def sample(self, size):
-        return self.pi * self.gaussian1.sample(size) + (1 - self.pi) * self.gaussian2.sample(size)
+        return self.weighted_gaussian.sample(size)
+
+    def sample_(self, out):
+        return self.weighted_gaussian.sample_(out)
+
+    def to(self, device):
+        self.gaussian1.to(device)
+        self.gaussian2.to(device)
+        self.weighted_gaussian.to(device)
+        return self
 
     def log_prob(self, x):
         return self.pi * self.gaussian1.log_prob(x) + (1 - self.pi) * self.gaussian2.log_prob(x)
@@ -47,10 +76,20 @@ class ScaledMixtureGaussian(object):
 
 class Uniform:
     def __init__(self, a, b):
+        self.a = a
+        self.b = b
         self.dist = torch.distributions.uniform.Uniform(a, b)
 
     def sample(self, size):
         return self.dist.rsample(size)
 
+    def sample_(self, out):
+        return out.uniform_(self.a, self.b)
+
+    def to(self, device):
+        self.dist = torch.distributions.uniform.Uniform(torch.tensor(float(self.a), device=device),
+                                                        torch.tensor(float(self.b), device=device))
+        return self
+
     def log_prob(self, x):
-        return self.dist.log_prob(x.cpu())
\ No newline at end of file
+        return self.dist.log_prob(x)
\ No newline at end of file
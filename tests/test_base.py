@@ -0,0 +1,55 @@
+import numpy as np
+import pytest
+import torch
+
+from base import det, epistemic_aleatoric_uncertainty, get_bayesian_network, get_network
+from priors import Gaussian
+
+
+def _reference(p):
+    # float64 determinants normalised as in the original implementation
+    p = p.double().transpose(0, 1).numpy()
+    p_hat = p.mean(1)
+    classes = p.shape[-1]
+
+    mn = 1 / classes ** classes
+    mx = mn * (2 ** (classes - 1))
+
+    dets = []
+    for _p, _p_hat in zip(p, p_hat):
+        var = sum(np.diag(s) - np.outer(s, s) + np.outer(s - _p_hat, s - _p_hat) for s in _p) / len(_p)
+        dets.append((np.linalg.det(var + np.eye(classes) / classes) - mn) / (mx - mn))
+
+    return np.array(dets)
+
+
+@pytest.mark.parametrize('classes', [10, 100])
+@pytest.mark.parametrize('samples', [1, 5])
+def test_uncertainty_many_classes(classes, samples):
+    torch.manual_seed(0)
+    x = torch.randn(samples, 8, classes) * 3
+
+    determinants, variances = epistemic_aleatoric_uncertainty(x)
+
+    assert np.isfinite(determinants).all()
+    np.testing.assert_allclose(determinants, _reference(torch.softmax(x, 2)), rtol=1e-3, atol=1e-6)
+    np.testing.assert_allclose(det(variances.astype(np.float64)), determinants, rtol=1e-3, atol=1e-6)
+
+
+def test_networks_end_with_conv_and_activation():
+    topology = [[4, 3, 1, 0], 'ReLU']
+    x = torch.randn(2, 3, 8, 8)
+
+    bayesian = get_bayesian_network(topology, x[0], classes=10, mu_init=None, rho_init=None, prior=Gaussian(0, 1),
+                                    divergence='kl', local_trick=False, posterior_type='weights')
+    network = get_network(topology, x[0], classes=10)
+
+    assert bayesian[-1].in_size == network[-1].in_features == 4 * 6 * 6
+
+    for net in (bayesian, network):
+        o = x
+        for layer in net:
+            o = layer(o)
+            if isinstance(o, tuple):
+                o = o[0]
+        assert o.shape == (2, 10)
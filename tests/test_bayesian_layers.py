@@ -0,0 +1,18 @@
+import torch
+
+from bayesian_layers import BayesianLinearLayer
+from priors import Gaussian, Laplace
+
+
+def test_mmd_backward_after_two_forwards():
+    torch.manual_seed(0)
+    x = torch.randn(3, 5)
+
+    for layer in (BayesianLinearLayer(5, 4, 'mmd', prior=Gaussian(0, 1)),
+                  BayesianLinearLayer(5, 4, 'mmd', prior=Laplace(0, 1), local_rep_trick=True)):
+        layer.train()
+        _, mmd1 = layer(x)
+        _, mmd2 = layer(x)
+        (mmd1 + mmd2).backward()
+
+        assert layer.w.mu.grad is not None